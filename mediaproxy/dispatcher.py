@@ -3,13 +3,12 @@
 
 import hashlib
 import random
+import re
 import signal
 import pickle as pickle
-import json
-from json import JSONDecodeError
 
 from base64 import b64encode as base64_encode
-from collections import deque
+from collections import defaultdict, deque
 
 from time import time
 
@@ -22,45 +21,54 @@ from twisted.protocols.basic import LineOnlyReceiver
 from twisted.python import failure
 from twisted.internet.error import ConnectionDone, TCPTimedOutError
 from twisted.internet.protocol import Factory, connectionDone
-from twisted.internet.defer import Deferred, DeferredList, maybeDeferred, succeed
+from twisted.internet.threads import deferToThread
+from twisted.internet.defer import Deferred, DeferredList, fail, inlineCallbacks, maybeDeferred, succeed
 from twisted.internet import reactor
 
 from mediaproxy import __version__
 from mediaproxy.configuration import DispatcherConfig
 from mediaproxy.interfaces import opensips
+from mediaproxy.json_compat import loads, dumps, JSONDecodeError
 from mediaproxy.scheduler import RecurrentCall, KeepRunning
 from mediaproxy.tls import X509Credentials
 
 
+# matches the call_id values in a relay's sessions reply, without decoding the whole reply
+_call_id_re = re.compile(rb'"call_id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
 class CommandError(Exception):
     pass
 
 
 class Command(object):
+    __slots__ = ('name', 'headers', 'call_id', 'dialog_id', 'media_relay', 'session_id')
+
     def __init__(self, name, headers=None):
         self.name = name
         self.headers = headers or []
-        try:
-            self.parsed_headers = dict(header.split(': ', 1) for header in self.headers)
-        except Exception:
-            raise CommandError('Could not parse command headers')
+        call_id = dialog_id = media_relay = None
+        for header in self.headers:
+            # only the headers used by the dispatcher are extracted, the rest are passed to the relay as they are
+            if header.startswith(b'call_id: '):
+                call_id = header[9:]
+            elif header.startswith(b'dialog_id: '):
+                dialog_id = header[11:]
+            elif header.startswith(b'media_relay: '):
+                media_relay = header[13:]
+            elif b': ' not in header:
+                raise CommandError('Could not parse command headers')
+        self.call_id = call_id.decode() if call_id is not None else None
+        self.dialog_id = dialog_id.decode() if dialog_id is not None else None
+        self.media_relay = media_relay.decode() if media_relay is not None else None
+        if call_id:
+            self.session_id = base64_encode(hashlib.md5(call_id).digest()).rstrip(b'=')
         else:
-            if self.call_id:
-                self.__dict__['session_id'] = base64_encode(hashlib.md5(self.call_id.encode()).digest()).rstrip(b'=')
-            else:
-                self.__dict__['session_id'] = None
-
-    @property
-    def call_id(self):
-        return self.parsed_headers.get('call_id')
+            self.session_id = None
 
     @property
-    def dialog_id(self):
-        return self.parsed_headers.get('dialog_id')
-
-    @property
-    def session_id(self):
-        return self.__dict__['session_id']
+    def parsed_headers(self):
+        return dict(header.partition(b': ')[::2] for header in self.headers)
 
 
 class ProtocolLogger(log.ContextualLogger):
@@ -102,16 +110,16 @@ class ControlProtocol(LineOnlyReceiver):
         self.factory.connection_lost(self)
 
     def reply(self, reply):
-        self.transport.write(reply.encode() + self.delimiter)
+        self.transport.write(reply + self.delimiter)
 
     def _error_handler(self, failure):
         failure.trap(CommandError, RelayError)
         self.logger.error(failure.value)
-        self.reply('error')
+        self.reply(b'error')
 
     def _catch_all(self, failure):
         self.logger.error(failure.getTraceback())
-        self.reply('error')
+        self.reply(b'error')
 
     def _decrement(self, result):
         self.in_progress = 0
@@ -128,23 +136,29 @@ class ControlProtocol(LineOnlyReceiver):
 class OpenSIPSControlProtocol(ControlProtocol):
     logger = ProtocolLogger(name='OpenSIPS Interface')
 
+    terminator = b'\r\n\r\n'
+
     def __init__(self):
-        self.request_lines = []
+        self.buffer = b''
         ControlProtocol.__init__(self)
 
-    def lineReceived(self, line):
-        line = line.decode()
-        if line == '':
-            if self.request_lines:
+    def dataReceived(self, data):
+        # requests end with an empty line, so split the data into whole requests instead of handling it line by line
+        requests = (self.buffer + data).split(self.terminator)
+        self.buffer = requests.pop()
+        for request in requests:
+            if self.transport.disconnecting:
+                return
+            request_lines = [line for line in request.split(self.delimiter) if line and not line.endswith(b': ')]
+            if request_lines:
                 self.in_progress += 1
-                defer = maybeDeferred(self.handle_request, self.request_lines)
+                defer = maybeDeferred(self.handle_request, request_lines)
                 self._add_callbacks(defer)
-                self.request_lines = []
-        elif not line.endswith(': '):
-            self.request_lines.append(line)
+        if len(self.buffer) > self.MAX_LENGTH:
+            self.lineLengthExceeded(self.buffer)
 
     def handle_request(self, request_lines):
-        command = Command(name=request_lines[0], headers=request_lines[1:])
+        command = Command(name=request_lines[0].decode(), headers=request_lines[1:])
         if command.call_id is None:
             raise CommandError('Request is missing the call_id header')
         return self.factory.dispatcher.send_command(command)
@@ -181,10 +195,10 @@ class ManagementControlProtocol(ControlProtocol):
             defer = self.factory.dispatcher.relay_factory.get_statistics()
             self._add_callbacks(defer)
         elif line == 'version':
-            self.reply(__version__)
+            self.reply(__version__.encode())
         else:
             self.logger.error('Unknown command: %s' % line)
-            self.reply('error')
+            self.reply(b'error')
 
 
 class ControlFactory(Factory):
@@ -235,9 +249,16 @@ class ConnectionReplaced(ConnectionDone):
     pass
 
 
+# failures that can be raised repeatedly are created once, to avoid capturing the traceback each time
+_no_relay_failure = failure.Failure(RelayError('No suitable relay found'))
+_timed_out_failure = failure.Failure(TCPTimedOutError())
+
+
 class RelayServerProtocol(LineOnlyReceiver):
     MAX_LENGTH = 4096*1024  # 4MB
     noisy = False
+    delimiter = b'\r\n'
+    terminator = 2 * delimiter
 
     def __init__(self):
         self.ip = None      # type: str
@@ -248,23 +269,24 @@ class RelayServerProtocol(LineOnlyReceiver):
         self.disconnect_timer = None
         self.sequence_number = 0
         self.authenticated = False
+        self.relay_timeout = DispatcherConfig.relay_timeout
 
     @property
     def active(self):
         return not self.halting and not self.timedout
 
     def send_command(self, command):
-        if command.call_id:
+        if command.session_id is not None:
             self.logger.info('Requesting {0.name!r} for session {0.session_id}'.format(command))
         else:
             self.logger.info('Requesting {0.name!r}'.format(command))
-        sequence_number = str(self.sequence_number)
-        self.sequence_number += 1
+        sequence_number = self.sequence_number
+        self.sequence_number = sequence_number + 1
         defer = Deferred()
-        timer = reactor.callLater(DispatcherConfig.relay_timeout, self._timeout, sequence_number)
-        self.commands[sequence_number] = (command, defer, timer)
-        to_write = [elem.encode() for elem in ['{} {}'.format(command.name, sequence_number)] + command.headers]
-        self.transport.write(self.delimiter.join(to_write) + 2 * self.delimiter)
+        defer.command = command  # the command and its timer are kept on the deferred, which is the pending entry
+        defer.timer = reactor.callLater(self.relay_timeout, self._timeout, sequence_number)
+        self.commands[sequence_number] = defer
+        self.transport.write(self.delimiter.join([('%s %d' % (command.name, sequence_number)).encode()] + command.headers) + self.terminator)
         return defer
 
     def reply(self, reply):
@@ -272,11 +294,12 @@ class RelayServerProtocol(LineOnlyReceiver):
         self.transport.write(reply + self.delimiter)
 
     def _timeout(self, sequence_number):
-        command, defer, timer = self.commands.pop(sequence_number)
-        defer.errback(RelayError('%r command failed: relay at %s timed out' % (command.name, self.ip)))
+        defer = self.commands.pop(sequence_number)
+        defer.errback(RelayError('%r command failed: relay at %s timed out' % (defer.command.name, self.ip)))
         if self.timedout is False:
             self.timedout = True
-            self.disconnect_timer = reactor.callLater(DispatcherConfig.relay_recover_interval, self.transport.connectionLost, failure.Failure(TCPTimedOutError()))
+            self.factory.relay_state_changed(self)
+            self.disconnect_timer = reactor.callLater(DispatcherConfig.relay_recover_interval, self.transport.connectionLost, _timed_out_failure)
 
     def connectionMade(self):
         peer = self.transport.getPeer()
@@ -295,17 +318,14 @@ class RelayServerProtocol(LineOnlyReceiver):
         self.factory.new_relay(self)
 
     def lineReceived(self, line):
-        line = line.decode()
-        log.debug(f"Line received: {line} from {self.transport.getPeer().host}:{self.transport.getPeer().port}")
-        try:
-            first, rest = line.split(' ', 1)
-        except ValueError:
-            first = line
-            rest = ''
+        if log.level.current == log.level.DEBUG:
+            peer = self.transport.getPeer()
+            log.debug(f"Line received: {line.decode()} from {peer.host}:{peer.port}")
+        first, _, rest = line.partition(b' ')
 
-        if first == 'expired':
+        if first == b'expired':
             try:
-                stats = json.loads(rest)
+                stats = loads(rest)
             except JSONDecodeError as e:
                 self.logger.error('Could not decode JSON: {}'.format(e))
             else:
@@ -317,7 +337,7 @@ class RelayServerProtocol(LineOnlyReceiver):
                 if session.relay_ip != self.ip:
                     session.logger.error('relay at %s reported the session as expired, ignoring' % self.ip)
                     return
-                all_streams_ice = all(stream_info['status'] == 'unselected ICE candidate' for stream_info in stats['streams'])
+                all_streams_ice = {stream_info['status'] for stream_info in stats['streams']} <= {'unselected ICE candidate'}
                 if all_streams_ice:
                     session.logger.info('removed because ICE was used')
                     stats['timed_out'] = False
@@ -328,44 +348,44 @@ class RelayServerProtocol(LineOnlyReceiver):
                 stats['all_streams_ice'] = all_streams_ice
                 self.factory.dispatcher.update_statistics(session, stats)
                 if session.dialog_id is not None and stats['start_time'] is not None and not all_streams_ice:
-                    self.factory.dispatcher.opensips_management.end_dialog(session.dialog_id)
+                    self.factory.dispatcher.end_dialog(session.dialog_id)
                     session.expire_time = time()
                 else:
-                    del self.factory.sessions[call_id]
+                    self.factory.remove_session(call_id)
             return
-        elif first == 'ping':
+        elif first == b'ping':
             if self.timedout is True:
                 self.timedout = False
                 if self.disconnect_timer.active():
                     self.disconnect_timer.cancel()
                 self.disconnect_timer = None
+                self.factory.relay_state_changed(self)
             self.reply(b'pong')
             return
 
         try:
-            command, defer, timer = self.commands.pop(first)
-        except KeyError:
-            self.logger.error('Got unexpected response: {}'.format(line))
+            defer = self.commands.pop(int(first))
+        except (KeyError, ValueError):
+            self.logger.error('Got unexpected response: {}'.format(line.decode()))
             return
-        timer.cancel()
-        if rest == 'error':
+        defer.timer.cancel()
+        if rest == b'error':
             defer.errback(RelayError('Relay replied with error'))
-        elif rest == 'halting':
+        elif rest == b'halting':
             self.halting = True
+            self.factory.relay_state_changed(self)
             defer.errback(RelayError('Relay is shutting down'))
-        elif command.name == 'remove':
+        elif defer.command.name == 'remove':
             try:
-                stats = json.loads(rest)
+                stats = loads(rest)
             except JSONDecodeError:
                 self.logger.error('Error decoding JSON')
             else:
-                call_id = stats['call_id']
-                session = self.factory.sessions[call_id]
+                session = self.factory.remove_session(stats['call_id'])
                 stats['dialog_id'] = session.dialog_id
                 stats['timed_out'] = False
                 self.factory.dispatcher.update_statistics(session, stats)
-                del self.factory.sessions[call_id]
-            defer.callback('removed')
+            defer.callback(b'removed')
         else:  # update command
             defer.callback(rest)
 
@@ -376,8 +396,8 @@ class RelayServerProtocol(LineOnlyReceiver):
 #            self.logger.warning('Connection replaced')
 #        else:
         self.logger.error('Connection lost: {}'.format(reason.value))
-        for command, defer, timer in self.commands.values():
-            timer.cancel()
+        for defer in self.commands.values():
+            defer.timer.cancel()
             defer.errback(RelayError('Relay disconnected'))
         if self.timedout is True:
             self.timedout = False
@@ -388,6 +408,8 @@ class RelayServerProtocol(LineOnlyReceiver):
 
 
 class RelaySession(object):
+    __slots__ = ('relay_ip', 'call_id', 'session_id', 'dialog_id', 'logger', 'expire_time')
+
     def __init__(self, relay, command):
         self.relay_ip = relay.ip
         self.call_id = command.call_id
@@ -397,12 +419,12 @@ class RelaySession(object):
         self.expire_time = None
 
     def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['logger']
-        return state
+        return self.relay_ip, self.call_id, self.session_id, self.dialog_id, self.expire_time
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        if isinstance(state, dict):  # state saved by older versions, which pickled the instance __dict__
+            state = state['relay_ip'], state['call_id'], state['session_id'], state['dialog_id'], state['expire_time']
+        self.relay_ip, self.call_id, self.session_id, self.dialog_id, self.expire_time = state
         self.logger = SessionLogger(self)
 
 
@@ -413,23 +435,27 @@ class RelayFactory(Factory):
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
         self.relays = {}
+        self.active_relays = []
         self.shutting_down = False
         state_file = process.runtime.file('dispatcher_state')
         try:
-            self.sessions = pickle.load(open(state_file))
+            with open(state_file, 'rb') as state:
+                self.sessions = pickle.load(state)
         except Exception:
             self.sessions = {}
-            self.cleanup_timers = {}
-        else:
-            self.cleanup_timers = dict((ip, reactor.callLater(DispatcherConfig.cleanup_dead_relays_after, self._do_cleanup, ip)) for ip in set(session.relay_ip for session in self.sessions.values()))
+        self.sessions_by_relay = defaultdict(set)
+        for call_id, session in self.sessions.items():
+            self.sessions_by_relay[session.relay_ip].add(call_id)
+        self.cleanup_timers = dict((ip, reactor.callLater(DispatcherConfig.cleanup_dead_relays_after, self._do_cleanup, ip)) for ip in self.sessions_by_relay)
         unlink(state_file)
         self.expired_cleaner = RecurrentCall(600, self._remove_expired_sessions)
 
     def _remove_expired_sessions(self):
         now, limit = time(), DispatcherConfig.cleanup_expired_sessions_after
-        obsolete = [k for k, s in filter(lambda k_s: k_s[1].expire_time and (now-k_s[1].expire_time>=limit), iter(self.sessions.items()))]
+        obsolete = [call_id for call_id, session in self.sessions.items() if session.expire_time is not None and now - session.expire_time >= limit]
         if obsolete:
-            [self.sessions.pop(call_id) for call_id in obsolete]
+            for call_id in obsolete:
+                self.remove_session(call_id)
             log.warning('found %d expired sessions which were not removed during the last %d hours' % (len(obsolete), round(limit / 3600.0)))
         return KeepRunning
 
@@ -445,22 +471,35 @@ class RelayFactory(Factory):
         if old_relay is not None:
             relay.logger.warning('Reconnected, closing old connection')
             reactor.callLater(0, old_relay.transport.connectionLost, failure.Failure(ConnectionReplaced('relay reconnected')))
+            if old_relay in self.active_relays:
+                self.active_relays.remove(old_relay)
         self.relays[relay.ip] = relay
+        self.active_relays.append(relay)
         timer = self.cleanup_timers.pop(relay.ip, None)
         if timer is not None:
             timer.cancel()
         defer = relay.send_command(Command('sessions'))
         defer.addCallback(self._cb_purge_sessions, relay.ip)
 
+    def relay_state_changed(self, relay):
+        if relay.active and self.relays.get(relay.ip) is relay:
+            if relay not in self.active_relays:
+                self.active_relays.append(relay)
+        elif relay in self.active_relays:
+            self.active_relays.remove(relay)
+
     def _cb_purge_sessions(self, result, relay_ip):
-        relay_sessions = json.loads(result)
-        relay_call_ids = [session['call_id'] for session in relay_sessions]
-        for session_id, session in list(self.sessions.items()):
-            if session.expire_time is None and session.relay_ip == relay_ip and session_id not in relay_call_ids:
+        if result[:1] != b'[' or result.rstrip()[-1:] != b']':
+            log.error('Invalid sessions reply from relay at %s, not purging its sessions' % relay_ip)
+            return
+        relay_call_ids = {loads(b'"%s"' % call_id) if b'\\' in call_id else call_id.decode() for call_id in _call_id_re.findall(result)}
+        for call_id in self.sessions_by_relay.get(relay_ip, set()) - relay_call_ids:
+            session = self.sessions[call_id]
+            if session.expire_time is None:
                 session.logger.warning('Relay does not have the session anymore, statistics are probably lost')
                 if session.dialog_id is not None:
-                    self.dispatcher.opensips_management.end_dialog(session.dialog_id)
-                del self.sessions[session_id]
+                    self.dispatcher.end_dialog(session.dialog_id)
+                self.remove_session(call_id)
 
     def send_command(self, command):
         session = self.sessions.get(command.call_id, None)
@@ -468,45 +507,53 @@ class RelayFactory(Factory):
             relay = session.relay_ip
             if relay not in self.relays:
                 session.logger.error('Request {0.name!r} failed: relay no longer connected'.format(command))
-                raise RelayError('Request {0.name!r} failed: relay no longer connected'.format(command))
+                return fail(RelayError('Request {0.name!r} failed: relay no longer connected'.format(command)))
             return self.relays[relay].send_command(command)
         # We do not have a session for this call_id or the session is already expired
         if command.name == 'update':
-            preferred_relay = command.parsed_headers.get('media_relay')
-            try_relays = deque(protocol for protocol in self.relays.values() if protocol.active and protocol.ip != preferred_relay)
-            random.shuffle(try_relays)
+            preferred_relay = command.media_relay
+            candidates = [protocol for protocol in self.active_relays if protocol.ip != preferred_relay]
+            random.shuffle(candidates)
             if preferred_relay is not None:
                 protocol = self.relays.get(preferred_relay)
                 if protocol is not None and protocol.active:
-                    try_relays.appendleft(protocol)
+                    candidates.insert(0, protocol)
                 else:
                     log.warning('user requested media_relay %s is not available' % preferred_relay)
-            defer = self._try_next(try_relays, command)
-            defer.addCallback(self._add_session, try_relays, command)
-            return defer
+            if not candidates:
+                return fail(_no_relay_failure)
+            return self._try_relays(candidates, command)
         elif command.name == 'remove' and session:
             # This is the remove we received for an expired session for which we triggered dialog termination
-            del self.sessions[command.call_id]
-            return 'removed'
+            self.remove_session(command.call_id)
+            return b'removed'
         else:
-            raise RelayError('Got {0.name!r} for unknown session {0.session_id}'.format(command))
-
-    def _add_session(self, result, try_relays, command):
-        self.sessions[command.call_id] = RelaySession(try_relays[0], command)
-        return result
-
-    def _relay_error(self, failure, try_relays, command):
-        failure.trap(RelayError)
-        failed_relay = try_relays.popleft()
-        failed_relay.logger.warning('The {0.name!r} request failed: {1.value}'.format(command, failure))
-        return self._try_next(try_relays, command)
-
-    def _try_next(self, try_relays, command):
-        if len(try_relays) == 0:
-            raise RelayError('No suitable relay found')
-        defer = try_relays[0].send_command(command)
-        defer.addErrback(self._relay_error, try_relays, command)
-        return defer
+            return fail(RelayError('Got {0.name!r} for unknown session {0.session_id}'.format(command)))
+
+    @inlineCallbacks
+    def _try_relays(self, try_relays, command):
+        for relay in try_relays:
+            try:
+                result = yield relay.send_command(command)
+            except RelayError as e:
+                relay.logger.warning('The {0.name!r} request failed: {1}'.format(command, e))
+            else:
+                self._add_session(relay, command)
+                return result
+        raise RelayError('No suitable relay found')
+
+    def _add_session(self, relay, command):
+        session = RelaySession(relay, command)
+        old_session = self.sessions.get(session.call_id)
+        if old_session is not None:
+            self.sessions_by_relay[old_session.relay_ip].discard(session.call_id)
+        self.sessions[session.call_id] = session
+        self.sessions_by_relay[session.relay_ip].add(session.call_id)
+
+    def remove_session(self, call_id):
+        session = self.sessions.pop(call_id)
+        self.sessions_by_relay[session.relay_ip].discard(call_id)
+        return session
 
     def get_summary(self):
         command = Command('summary')
@@ -516,10 +563,17 @@ class RelayFactory(Factory):
 
     def _summary_error(self, failure, command, relay):
         relay.logger.error('The {0.name!r} request failed: {1.value}'.format(command, failure))
-        return json.dumps(dict(status='error', ip=relay.ip))
+        return dumps(dict(status='error', ip=relay.ip))
 
     def _got_summaries(self, results):
-        return '[%s]' % ', '.join(result for succeeded, result in results if succeeded)
+        buffer = bytearray(b'[')
+        for succeeded, result in results:
+            if succeeded:
+                if len(buffer) > 1:
+                    buffer += b', '
+                buffer += result
+        buffer += b']'
+        return bytes(buffer)
 
     def get_statistics(self):
         command = Command('sessions')
@@ -529,16 +583,25 @@ class RelayFactory(Factory):
 
     def _statistics_error(self, failure, command, relay):
         relay.logger.error('The {0.name!r} request failed: {1.value}'.format(command, failure))
-        return json.loads([])
+        return dumps([])
 
     def _got_statistics(self, results):
-        return '[%s]' % ', '.join(result[1:-1] for succeeded, result in results if succeeded and result != '[]')
+        buffer = bytearray(b'[')
+        for succeeded, result in results:
+            if succeeded and result != b'[]':
+                if len(buffer) > 1:
+                    buffer += b', '
+                buffer += memoryview(result)[1:-1]  # strip the brackets without copying the relay's list
+        buffer += b']'
+        return bytes(buffer)
 
     def connection_lost(self, relay):
-        if relay not in iter(self.relays.values()):
+        if self.relays.get(relay.ip) is not relay:
             return
         if relay.authenticated:
             del self.relays[relay.ip]
+        if relay in self.active_relays:
+            self.active_relays.remove(relay)
         if self.shutting_down:
             if len(self.relays) == 0:
                 self.defer.callback(None)
@@ -548,13 +611,14 @@ class RelayFactory(Factory):
     def _do_cleanup(self, ip):
         log.debug('Cleaning up after old relay at %s' % ip)
         del self.cleanup_timers[ip]
-        for call_id in (call_id for call_id, session in list(self.sessions.items()) if session.relay_ip == ip):
+        for call_id in self.sessions_by_relay.pop(ip, ()):
             del self.sessions[call_id]
 
     def shutdown(self):
         if self.shutting_down:
             return
         self.shutting_down = True
+        self.expired_cleaner.cancel()
         for timer in self.cleanup_timers.values():
             timer.cancel()
         if len(self.relays) == 0:
@@ -568,7 +632,12 @@ class RelayFactory(Factory):
         return retval
 
     def _save_state(self, result):
-        pickle.dump(self.sessions, open(process.runtime.file('dispatcher_state'), 'wb'))
+        # nothing modifies the sessions anymore once the relays are disconnected and the expired cleaner is cancelled
+        return deferToThread(self._write_state, process.runtime.file('dispatcher_state'))
+
+    def _write_state(self, state_file):
+        with open(state_file, 'wb') as state:
+            pickle.dump(self.sessions, state, pickle.HIGHEST_PROTOCOL)
 
 
 class Dispatcher(object):
@@ -584,6 +653,8 @@ class Dispatcher(object):
         unlink(socket_path)
         self.opensips_listener = reactor.listenUNIX(socket_path, self.opensips_factory)
         self.opensips_management = opensips.ManagementInterface()
+        self._end_dialog_queue = deque()
+        self._end_dialog_flush_scheduled = False
         self.management_factory = ManagementControlFactory(self)
         management_addr, management_port = DispatcherConfig.listen_management
         if DispatcherConfig.management_use_tls:
@@ -607,6 +678,23 @@ class Dispatcher(object):
     def send_command(self, command):
         return maybeDeferred(self.relay_factory.send_command, command)
 
+    def end_dialog(self, dialog_id):
+        # queue the request and send all queued requests together on the next reactor iteration
+        self._end_dialog_queue.append(dialog_id)
+        if not self._end_dialog_flush_scheduled:
+            self._end_dialog_flush_scheduled = True
+            reactor.callLater(0, self._flush_end_dialog_queue)
+
+    def _flush_end_dialog_queue(self):
+        self._end_dialog_flush_scheduled = False
+        queue = self._end_dialog_queue
+        while queue:
+            dialog_id = queue.popleft()
+            try:
+                self.opensips_management.end_dialog(dialog_id)
+            except Exception as e:
+                log.exception('An unhandled error occurred while ending dialog %s: %s' % (dialog_id, e))
+
     def update_statistics(self, session, stats):
         session.logger.info('statistics: {}'.format(stats))
         if stats['start_time'] is not None:
@@ -0,0 +1,20 @@
+
+"""JSON encoding and decoding using the fastest available implementation"""
+
+__all__ = ['loads', 'dumps', 'JSONDecodeError']
+
+
+# All implementations accept both bytes and str in loads and the exported
+# dumps always returns bytes, which can be written to a transport directly.
+
+try:
+    from orjson import loads, dumps, JSONDecodeError
+except ImportError:
+    try:
+        from ujson import loads, dumps as _dumps
+        JSONDecodeError = ValueError
+    except ImportError:
+        from json import loads, dumps as _dumps, JSONDecodeError
+
+    def dumps(obj):
+        return _dumps(obj).encode()